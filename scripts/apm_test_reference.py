@@ -1,7 +1,7 @@
 """Standalone DDTrace + Modal test service with Datadog APM.
 
 This is a complete, standalone example for integrating Datadog APM with Modal.
-Uses structlog for structured logging with Modal context injection.
+Uses structlog (orjson-rendered) for structured logging with Modal context injection.
 
 Deploy: MODAL_ENVIRONMENT=dev modal deploy apm_test_reference.py
 Test:   MODAL_ENVIRONMENT=dev pytest test_apm_smoke.py -v -s
@@ -12,8 +12,15 @@ Requirements:
 """
 
 import asyncio
+import contextvars
 import os
+import queue
 import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
 from modal import App, Image, Secret, concurrent, enter, exit, method
 
 # =============================================================================
@@ -29,6 +36,15 @@ DD_VERSION = os.getenv("GIT_SHA", "1.0.0")
 DD_SITE = os.getenv("DD_SITE", "datadoghq.com")
 DD_TAGS = f"env:{DD_ENV},service:{DD_SERVICE}"
 
+# Anomaly simulation - outcomes are pre-sampled per container and cycled through
+ANOMALY_MASK_SIZE = 1 << 16  # must stay a power of two (indexed with a bitmask)
+SLOW_RENDER_RATE = 0.05
+SLOW_LLM_RATE = 0.10
+
+# Trace flush policy - flush every N calls or after T seconds, whichever comes first
+FLUSH_EVERY_N_CALLS = 16
+FLUSH_INTERVAL_S = 2.0
+
 # =============================================================================
 # Modal Image Definition
 # =============================================================================
@@ -45,6 +61,7 @@ image = (
     .pip_install(
         "ddtrace==4.1.2",
         "structlog>=24.0.0",
+        "orjson",
     )
     .env(
         {
@@ -68,58 +85,148 @@ image = (
 app = App(name=app_name, image=image)
 
 # =============================================================================
-# DDTrace + Structlog Initialization (runs at image import time)
+# DDTrace + Structlog Setup (structlog is configured lazily from init())
 # =============================================================================
 
 with image.imports():
+    import logging
+
+    import orjson
     import structlog
     from ddtrace import patch, tracer
 
     # Patch logging for trace ID injection
     patch(logging=True)
 
-    def add_modal_context(logger, method_name, event_dict):
-        """Add Modal runtime context to all log entries."""
-        event_dict["modal"] = {
-            "is_remote": os.getenv("MODAL_IS_REMOTE", "0"),
-            "environment": os.getenv("MODAL_ENVIRONMENT", "unknown"),
-            "region": os.getenv("MODAL_REGION", "unknown"),
-            "task_id": os.getenv("MODAL_TASK_ID", "unknown"),
-            "image_id": os.getenv("MODAL_IMAGE_ID", "unknown"),
-        }
-        return event_dict
-
-    def add_datadog_context(logger, method_name, event_dict):
-        """Add Datadog trace context for log correlation."""
-        current_span = tracer.current_span()
-        if current_span:
-            event_dict["dd"] = {
-                "trace_id": str(current_span.trace_id),
-                "span_id": str(current_span.span_id),
-                "service": current_span.service,
+    # Modal runtime context is fixed for the lifetime of a container, so snapshot
+    # it once instead of re-reading the environment on every log event.
+    # Treat as read-only: the same dict is shared by every log entry.
+    MODAL_CTX = {
+        "is_remote": os.environ.get("MODAL_IS_REMOTE", "0"),
+        "environment": os.environ.get("MODAL_ENVIRONMENT", "unknown"),
+        "region": os.environ.get("MODAL_REGION", "unknown"),
+        "task_id": os.environ.get("MODAL_TASK_ID", "unknown"),
+        "image_id": os.environ.get("MODAL_IMAGE_ID", "unknown"),
+    }
+
+    # Datadog log-correlation fields for the active span, stringified once when
+    # the span is entered rather than on every log event inside it
+    _DD_CTX: contextvars.ContextVar = contextvars.ContextVar("dd_log_context", default=None)
+    # With tracing disabled (e.g. local runs without an agent) there is nothing to correlate.
+    # Read ddtrace's own resolved flag rather than re-parsing DD_TRACE_ENABLED.
+    _TRACE_ON = tracer.enabled
+
+    @contextmanager
+    def log_context(span):
+        """Publish span's log-correlation fields to _DD_CTX for the duration of the block."""
+        if not _TRACE_ON:
+            yield span
+            return
+        token = _DD_CTX.set(
+            {
+                "trace_id": str(span.trace_id),
+                "span_id": str(span.span_id),
+                "service": span.service,
             }
-        return event_dict
+        )
+        try:
+            yield span
+        finally:
+            _DD_CTX.reset(token)
 
-    # Configure structlog with Modal and Datadog context
-    structlog.configure(
-        processors=[
-            structlog.stdlib.add_log_level,
-            structlog.stdlib.add_logger_name,
-            structlog.processors.TimeStamper(fmt="iso"),
-            structlog.processors.StackInfoRenderer(),
-            add_modal_context,
-            add_datadog_context,
-            structlog.processors.format_exc_info,
-            structlog.processors.JSONRenderer(),
-        ],
-        wrapper_class=structlog.stdlib.BoundLogger,
-        context_class=dict,
-        logger_factory=structlog.PrintLoggerFactory(),
-        cache_logger_on_first_use=True,
-    )
+    @contextmanager
+    def trace_serverless(name):
+        """Serverless-type span for this service that publishes its log context to _DD_CTX."""
+        with tracer.trace(name, service=app_name, span_type="serverless") as span, log_context(span):
+            yield span
+
+    # Same normalisation as structlog.processors.add_log_level
+    _LEVEL_ALIASES = {"warn": "warning", "exception": "error"}
 
+    def add_log_fields(logger, method_name, event_dict):
+        """Add level, timestamp, Modal runtime context and Datadog trace context.
+
+        Fused into a single processor so each event costs one call before rendering.
+        The timestamp is epoch milliseconds (Datadog's native UNIX time format).
+        """
+        event_dict["level"] = _LEVEL_ALIASES.get(method_name, method_name)
+        event_dict["timestamp"] = time.time_ns() // 1_000_000
+        event_dict["modal"] = MODAL_CTX
+        dd_ctx = _DD_CTX.get()
+        if dd_ctx is not None:
+            event_dict["dd"] = dd_ctx
+        return event_dict
+
+    # Rendered log lines are handed to a background writer so process() never
+    # blocks on stdout; the request path only pays for an enqueue.
+    _log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+    def _drain_logs() -> None:
+        """Write queued log lines to stdout until a None sentinel arrives."""
+        out = sys.stdout.buffer
+        while True:
+            line = _log_queue.get()
+            if line is None:
+                out.flush()
+                return
+            out.write(line + b"\n")
+            if _log_queue.empty():
+                out.flush()
+
+    class QueuedLogger:
+        """structlog logger that enqueues rendered lines for the writer thread."""
+
+        def msg(self, message: bytes) -> None:
+            _log_queue.put_nowait(message)
+
+        log = debug = info = warn = warning = msg
+        fatal = failure = err = error = critical = exception = msg
+
+    _queued_logger = QueuedLogger()
+    _log_writer = threading.Thread(target=_drain_logs, name="log-writer", daemon=True)
+    _CONFIGURED = False
+
+    def _init_logging() -> None:
+        """Configure structlog and start the log writer (once per container)."""
+        global _CONFIGURED
+        if _CONFIGURED:
+            return
+        structlog.configure(
+            processors=[
+                add_log_fields,
+                # orjson renders straight to bytes, which QueuedLogger enqueues as-is
+                structlog.processors.JSONRenderer(serializer=orjson.dumps),
+            ],
+            # Calls below INFO return immediately, before any processor runs
+            wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
+            context_class=dict,
+            logger_factory=lambda *args: _queued_logger,
+            cache_logger_on_first_use=True,
+        )
+        _log_writer.start()
+        _CONFIGURED = True
+
+    def stop_log_writer(timeout: float = 1.0) -> None:
+        """Drain pending log lines and stop the writer thread."""
+        if not _log_writer.is_alive():
+            return
+        _log_queue.put_nowait(None)
+        _log_writer.join(timeout)
+
+    # Lazy proxy - resolves the configuration set by _init_logging() on first use
     logger = structlog.get_logger(__name__)
 
+    def _flush_traces() -> None:
+        """tracer.flush() for executor threads - failures are logged, never raised."""
+        try:
+            tracer.flush()
+        except Exception as exc:
+            logger.warning("trace_flush_failed", error=repr(exc))
+
+    def flush_traces_in_background() -> None:
+        """Schedule a trace flush on the default executor without awaiting it."""
+        asyncio.get_running_loop().run_in_executor(None, _flush_traces)
+
 
 # =============================================================================
 # Modal Service Class
@@ -135,16 +242,29 @@ class TestService:
     - Span hierarchy (root + child spans)
     - Span types for UI categorization
     - Tags and metrics on spans
-    - Explicit trace flushing for real-time visibility
+    - Batched trace flushing for near-real-time visibility
     - Structured logging with trace correlation
+    - Log output written off the request path by a background thread
     """
 
+    # Fields shared by every successful process() result
+    _RESULT_TEMPLATE = {"status": "success", "pages": 10}
+
     @enter()
     def init(self) -> None:
         """Initialize the service (runs once per container cold start)."""
-        with tracer.trace("modal.init", service=app_name, span_type="serverless"):
+        _init_logging()
+        with trace_serverless("modal.init"):
             logger.info("service_initializing", strategies=["mineru-vl", "dots-ocr"])
             self.strategies = ["mineru-vl", "dots-ocr"]
+            # Pre-sample anomaly outcomes so process() does list loads, not RNG calls
+            rng = random.Random()
+            self._slow_render_mask = [rng.random() < SLOW_RENDER_RATE for _ in range(ANOMALY_MASK_SIZE)]
+            self._slow_llm_mask = [rng.random() < SLOW_LLM_RATE for _ in range(ANOMALY_MASK_SIZE)]
+            self._i = 0
+            self._calls = 0
+            self._last_flush = time.monotonic()
+            self._trailing_flush = None
             logger.info("service_initialized")
 
     @method()
@@ -155,58 +275,94 @@ class TestService:
         - Root span with span_type="serverless" and span.kind="server"
         - Child spans with appropriate types (template, llm)
         - Random latency simulation for observing outliers in APM
-        - Explicit tracer.flush() in finally block for guaranteed trace emission
+        - Batched tracer.flush() in finally block, with a trailing timer so traces
+          from the last call of a burst are sent within FLUSH_INTERVAL_S
         """
+        # Hoist repeatedly used globals/attributes into locals (LOAD_FAST in the hot path)
+        _sleep = asyncio.sleep
+        _start_span = tracer.start_span
+        log = logger.bind(document_id=document_id, strategy=strategy)
+        i = self._i & (ANOMALY_MASK_SIZE - 1)
+        self._i += 1
         try:
             # Root span - the main operation (shows in trace list)
-            with tracer.trace("document.process", service=app_name, span_type="serverless") as root:
+            with trace_serverless("document.process") as root:
                 root.set_tag("document_id", document_id)
                 root.set_tag("strategy", strategy)
                 root.set_tag("span.kind", "server")  # Marks as entry point
-                logger.info("processing_document", document_id=document_id, strategy=strategy)
+                log.info("processing_document")
+
+                # Child spans come from start_span(), which does not activate them - nothing
+                # inside queries the active span. Using them as context managers still marks
+                # them as errors on exceptions, and log_context() keeps per-span log correlation.
 
                 # Child span 1 - PDF rendering (5% chance of 5x slower for anomaly detection demo)
-                with tracer.trace("document.render_pages", service=app_name, span_type="template") as render_span:
+                with _start_span(
+                    "document.render_pages", child_of=root, service=app_name, span_type="template"
+                ) as render_span, log_context(render_span):
                     render_span.set_metric("pages_count", 10)
-                    is_slow_render = random.random() < 0.05
-                    render_time = 1.0 if is_slow_render else 0.2
+                    is_slow_render = self._slow_render_mask[i]
+                    render_ms = 1000 if is_slow_render else 200
                     render_span.set_tag("slow_render", is_slow_render)
-                    await asyncio.sleep(render_time)
-                    logger.info("rendered_pages", pages=10, slow=is_slow_render, duration_ms=int(render_time * 1000))
+                    await _sleep(render_ms / 1000)
+                    log.info("rendered_pages", pages=10, slow=is_slow_render, duration_ms=render_ms)
 
                 # Child span 2 - LLM inference (10% chance of 3x slower for anomaly detection demo)
-                with tracer.trace("document.llm_extract", service=app_name, span_type="llm") as llm_span:
+                with _start_span(
+                    "document.llm_extract", child_of=root, service=app_name, span_type="llm"
+                ) as llm_span, log_context(llm_span):
                     llm_span.set_tag("model", "mineru-vl")
                     llm_span.set_metric("tokens_processed", 1500)
-                    is_slow_llm = random.random() < 0.10
-                    llm_time = 0.9 if is_slow_llm else 0.3
+                    is_slow_llm = self._slow_llm_mask[i]
+                    llm_ms = 900 if is_slow_llm else 300
                     llm_span.set_tag("slow_llm", is_slow_llm)
-                    await asyncio.sleep(llm_time)
-                    logger.info("extracted_content", tokens=1500, slow=is_slow_llm, duration_ms=int(llm_time * 1000))
+                    await _sleep(llm_ms / 1000)
+                    log.info("extracted_content", tokens=1500, slow=is_slow_llm, duration_ms=llm_ms)
 
                 # Set final metrics on root span
                 root.set_metric("total_pages", 10)
-                logger.info("document_processed_successfully")
+                log.info("document_processed_successfully")
 
-            return {
-                "document_id": document_id,
-                "strategy": strategy,
-                "status": "success",
-                "pages": 10,
-            }
+            result = self._RESULT_TEMPLATE.copy()
+            result["document_id"] = document_id
+            result["strategy"] = strategy
+            return result
         finally:
-            # CRITICAL: Flush traces in finally block - guarantees traces are sent even on
-            # early returns or exceptions. Without this, traces buffer until container
-            # shutdown (which rarely happens with Modal's warm containers).
-            tracer.flush()
+            # CRITICAL: Schedule a flush in the finally block - covers early returns and
+            # exceptions. Without it, traces buffer until container shutdown (which rarely
+            # happens with Modal's warm containers). Flushes are batched so concurrent
+            # inputs don't each pay for an agent POST: flush now once FLUSH_EVERY_N_CALLS
+            # calls or FLUSH_INTERVAL_S have accumulated, otherwise arm a trailing timer
+            # so every call's traces are sent within FLUSH_INTERVAL_S. The flush itself
+            # runs on an executor thread so it never blocks the event loop.
+            self._calls += 1
+            now = time.monotonic()
+            if self._calls >= FLUSH_EVERY_N_CALLS or now - self._last_flush > FLUSH_INTERVAL_S:
+                self._flush()
+            elif self._trailing_flush is None:
+                self._trailing_flush = asyncio.get_running_loop().call_later(FLUSH_INTERVAL_S, self._flush)
+
+    def _flush(self) -> None:
+        """Flush traces in the background and reset the batching state."""
+        if self._trailing_flush is not None:
+            self._trailing_flush.cancel()
+            self._trailing_flush = None
+        self._calls = 0
+        self._last_flush = time.monotonic()
+        flush_traces_in_background()
 
     @exit()
     async def finish(self) -> None:
         """Cleanup on container shutdown (rarely called due to warm containers)."""
-        with tracer.trace("modal.exit", service=app_name, span_type="serverless"):
+        with trace_serverless("modal.exit"):
             logger.info("service_shutting_down")
+        if self._trailing_flush is not None:
+            self._trailing_flush.cancel()
+            self._trailing_flush = None
+        tracer.flush()  # Unconditional - drains anything the batched policy held back
         tracer.shutdown()
         logger.info("tracer_shutdown_complete")
+        stop_log_writer()
 
 
 # =============================================================================